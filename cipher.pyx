@@ -0,0 +1,30 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+""" Compiled versions of the TP-Link XOR cipher from light.py. Build in place
+    with `cythonize -i cipher.pyx`; light.py falls back to NumPy without it.
+"""
+
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize
+
+
+def enc(const unsigned char[::1] byte_string):
+  cdef Py_ssize_t i, n = byte_string.shape[0]
+  cdef bytes out = PyBytes_FromStringAndSize(NULL, n)
+  cdef unsigned char *b = <unsigned char *>PyBytes_AS_STRING(out)
+  cdef unsigned char key = 0xAB
+
+  for i in range(n):
+    key ^= byte_string[i]
+    b[i] = key
+  return out
+
+
+def dec(const unsigned char[::1] byte_string):
+  cdef Py_ssize_t i, n = byte_string.shape[0]
+  cdef bytes out = PyBytes_FromStringAndSize(NULL, n)
+  cdef unsigned char *b = <unsigned char *>PyBytes_AS_STRING(out)
+  cdef unsigned char key = 0xAB
+
+  for i in range(n):
+    b[i] = key ^ byte_string[i]
+    key = byte_string[i]
+  return out.decode('ascii')
@@ -1,23 +1,32 @@
 #!/usr/bin/env python3
 
+import selectors
 import time
-from enum import Enum
 
 import sounddevice as sd
 import numpy as np
 
 
-class ELState(Enum):
-  New = 1
-  Setup = 2
-  Running = 3
-  Finished = 4
+_NEW = 1
+_SETUP = 2
+_RUNNING = 3
+_FINISHED = 4
+
+
+class ELState:
+  """ The lifecycle states of tasks and event loops. These are plain ints so
+      that state checks are cheap int comparisons
+  """
+  New = _NEW
+  Setup = _SETUP
+  Running = _RUNNING
+  Finished = _FINISHED
 
 
 class Task:
   """ The basic unit of work for the event loop. """
 
-  state = ELState.New
+  state = _NEW
 
   def setup(self):
     """ Any setup that needs to run when a task is started. Called with
@@ -37,15 +46,15 @@ class Task:
     pass
 
   def _setup(self, el):
-    if self.state == ELState.New:
+    if self.state == _NEW:
       self.el = el
       self.setup()
-      self.state = ELState.Setup
+      self.state = _SETUP
 
   def _finish(self):
-    if self.state in (ELState.Setup, ELState.Running):
+    if self.state == _SETUP or self.state == _RUNNING:
       self.finish()
-      self.state = ELState.Finished
+      self.state = _FINISHED
 
 
 class EventLoop:
@@ -64,37 +73,30 @@ class EventLoop:
       loop.run()
   """
 
-  @staticmethod
-  def _tick(task):
-    """ Helper method to tick a task and call finish if it's done """
-    if task.tick():
-      return True
-    else:
-      task._finish()
-      return False
-
   def __init__(self, target_fps=10, tasks=None):
     self.seconds_per_frame = 1.0 / float(target_fps)
     self.tasks = tasks if tasks else []
-    self.state = ELState.New
+    self.sel = selectors.DefaultSelector()
+    self.state = _NEW
 
   def run(self):
     """ Run this event loop forever """
     print(f"Running event loop @ {self.seconds_per_frame} seconds per frame")
     self.setup()
-    frame_len_t = 0
-    frame_start_t = 0
-    self.state = ELState.Running
+    now = time.monotonic_ns
+    wait = self.wait
+    frame_ns = int(self.seconds_per_frame * 1e9)
+    self.state = _RUNNING
 
     try:
       while self.run:
-        frame_start_t = time.time()
+        frame_start_ns = now()
         self.tick()
-        frame_len_t = time.time() - frame_start_t
+        sleep_ns = frame_ns - (now() - frame_start_ns)
 
-        self.sleep_time = self.seconds_per_frame - frame_len_t
-        if self.sleep_time > 0:
-          time.sleep(self.sleep_time)
+        self.sleep_time = sleep_ns * 1e-9
+        if sleep_ns > 0:
+          wait(self.sleep_time)
 
     except KeyboardInterrupt:
       print(" Quit.")
@@ -110,16 +112,55 @@ class EventLoop:
     self.run = True
 
     [t._setup(self) for t in self.tasks]
-    self.state = ELState.Setup
+    self.state = _SETUP
 
   def finish(self):
     [t._finish() for t in self.tasks]
-    self.state = ELState.Finished
+    self.sel.close()
+    self.state = _FINISHED
 
   def tick(self):
-    self.tasks = [t for t in self.tasks if EventLoop._tick(t)]
+    """ Tick every task, finishing and dropping the ones that are done. The
+        task list is compacted in place, so nothing is allocated unless a
+        task actually finishes
+    """
+    tasks = self.tasks
+    w = 0
+    for t in tasks:
+      if t.tick():
+        tasks[w] = t
+        w += 1
+      else:
+        t._finish()
+
+    if w != len(tasks):
+      del tasks[w:]
     self.frame += 1
 
+  def wait(self, timeout):
+    """ Sleep for timeout seconds, calling back any registered files that
+        become readable in the meantime
+    """
+    if not self.sel.get_map():
+      time.sleep(timeout)
+      return
+
+    deadline = time.monotonic() + timeout
+    while timeout > 0:
+      for key, _ in self.sel.select(timeout):
+        key.data()
+      timeout = deadline - time.monotonic()
+
+  def register(self, fileobj, callback):
+    """ Call callback() whenever fileobj is readable while the loop is
+        waiting for the next frame
+    """
+    self.sel.register(fileobj, selectors.EVENT_READ, callback)
+
+  def unregister(self, fileobj):
+    """ Stop calling back for fileobj """
+    self.sel.unregister(fileobj)
+
   def stop(self):
     self.run = False
 
@@ -148,13 +189,26 @@ class Poller(Task):
 
 
 class MovingAverage(Poller):
+  """ Averages the values of an underlying poller over the last window_size
+      frames
+  """
+
   def __init__(self, underlying, window_size, default=0):
     self.p = underlying
-    self.ws = window_size
-    self.data = np.full(window_size, default)
+    self.window_size = window_size
+    self.data = np.full(window_size, default, dtype=np.float64)
+    self.running_sum = float(self.data.sum())
+
+  def setup(self):
+    self.p._setup(self.el)
 
   def poll(self):
-    index = self.el.frame % window_size
-    self.data[index] = self.p.poll()
-    return self.fn()
+    index = self.el.frame % self.window_size
+    old = self.data.item(index)
+    v = self.p.poll()
+    self.data[index] = v
+    self.running_sum += v - old
+    return self.running_sum / self.window_size
 
+  def finish(self):
+    self.p._finish()
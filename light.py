@@ -1,61 +1,372 @@
+import functools
+import queue
+import selectors
 import socket
-import rapidjson as json
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
 
-def enc(ascii_string):
-  key = 0xAB
-  bs = bytearray(ascii_string, 'ascii')
-  for i, byte in enumerate(bs):
-    key = key ^ byte
-    bs[i] = key
-  return bytes(bs)
+import numpy as np
+import orjson
+
+_local = threading.local()
+
+
+def _scratch(n):
+  """ A per-thread buffer of at least n bytes that's reused between calls """
+  buf = getattr(_local, 'buf', None)
+  if buf is None or buf.size < n:
+    buf = _local.buf = np.empty(max(n, 2048), dtype=np.uint8)
+  return buf[:n]
+
+
+def enc(byte_string):
+  a = np.frombuffer(byte_string, dtype=np.uint8)
+  out = _scratch(a.size)
+  np.bitwise_xor.accumulate(a, out=out)
+  out ^= 0xAB
+  return out.tobytes()
 
 
 def dec(byte_string):
-  key = 0xAB
-  bs = bytearray(byte_string)
-  for i, byte in enumerate(bs):
-    bs[i] = key ^ byte
-    key = byte
-  return bs.decode('ascii')
+  a = np.frombuffer(byte_string, dtype=np.uint8)
+  out = _scratch(a.size)
+  if a.size:
+    out[0] = a[0] ^ 0xAB
+    np.bitwise_xor(a[1:], a[:-1], out=out[1:])
+  return str(out.data, 'ascii')
+
+
+try:
+  from cipher import enc, dec
+except ImportError:
+  pass
+
+
+def _module(cmd_string):
+  """ The top level key of a command or response, like "system" """
+  js = orjson.loads(cmd_string)
+  return next(iter(js), None) if isinstance(js, dict) else None
+
+
+class BulbIO(threading.Thread):
+  """ Sends bulb commands and collects their responses on a background
+      thread, so callers never block on the network. Each submitted command
+      gets a Future for its decoded response, unless it was sent without
+      one, in which case the response is just dropped. An addr of None means
+      the socket is connected to the bulb, and is sent on with send()
+      instead of sendto()
+
+      Bulbs don't echo any request id, so responses are matched to requests
+      by socket and address, oldest first. A command that needs a reply is
+      held back until everything sent before it is answered or expired, then
+      goes out alone after stale datagrams are drained. Replies are only
+      accepted for it if they're for the same top level module ("system",
+      "smartlife.iot.smartbulb.lightingservice"), so a late reply to some
+      other command can't be handed to it
+  """
+
+  def __init__(self):
+    super().__init__(name='BulbIO', daemon=True)
+    self.requests = queue.SimpleQueue()
+    self.pending = {}
+    self.held = {}
+    self.sel = selectors.DefaultSelector()
+    self.wake_r, self.wake_w = socket.socketpair()
+    self.wake_r.setblocking(False)
+    self.sel.register(self.wake_r, selectors.EVENT_READ)
+    self.start_lock = threading.Lock()
+    self.started = False
+
+  def submit(self, sock, enc_bytes, addr, timeout=1, reply=True):
+    """ Queue an encoded command to be sent from sock to addr. Returns a
+        Future for the response, or None if reply is False
+    """
+    if not self.started:
+      with self.start_lock:
+        if not self.started:
+          self.start()
+          self.started = True
+
+    fut = Future() if reply else None
+    self.requests.put((sock, enc_bytes, addr, timeout, fut))
+    self.wake_w.send(b'\0')
+    return fut
+
+  def close(self, sock, addr):
+    """ Cancel everything in flight from sock to addr and stop watching it.
+        A connected socket (addr of None) is closed as well
+    """
+    if not self.started:
+      if addr is None:
+        sock.close()
+      return
+
+    self.requests.put((sock, None, addr, None, None))
+    self.wake_w.send(b'\0')
+
+  def run(self):
+    while True:
+      for key, _ in self.sel.select(self._next_timeout()):
+        try:
+          if key.fileobj is self.wake_r:
+            self._send_requests()
+          else:
+            self._read_response(key)
+        except Exception:
+          traceback.print_exc()
+      self._expire()
+
+  @staticmethod
+  def _claim(fut):
+    """ True if fut is waiting on a result, i.e. it exists and the caller
+        hasn't cancelled it. Claimed futures can no longer be cancelled
+    """
+    return fut is not None and fut.set_running_or_notify_cancel()
+
+  def _send_requests(self):
+    try:
+      while self.wake_r.recv(4096):
+        pass
+    except BlockingIOError:
+      pass
+
+    while not self.requests.empty():
+      request = self.requests.get()
+      try:
+        self._handle_request(request)
+      except Exception as e:
+        fut = request[4]
+        if fut is not None and not fut.done() and self._claim(fut):
+          fut.set_exception(e)
+
+  def _handle_request(self, request):
+    sock, enc_bytes, addr, timeout, fut = request
+    if enc_bytes is None:
+      self._forget(sock, addr)
+      return
+
+    if sock not in self.sel.get_map():
+      sock.setblocking(False)
+      self.sel.register(sock, selectors.EVENT_READ, addr is None)
+
+    if self.held.get((sock, addr)) or not self._can_send((sock, addr), fut):
+      self.held.setdefault((sock, addr), deque()).append(request)
+    else:
+      self._send(*request)
+
+  def _forget(self, sock, addr):
+    for _, fut, _ in self.pending.pop((sock, addr), ()):
+      if fut is not None:
+        fut.cancel()
+    for request in self.held.pop((sock, addr), ()):
+      if request[4] is not None:
+        request[4].cancel()
+
+    if addr is None:
+      if sock in self.sel.get_map():
+        self.sel.unregister(sock)
+      sock.close()
+
+  def _can_send(self, key, fut):
+    """ Commands that need a reply wait for everything before them to finish.
+        Fire and forget commands only wait on a command that needs a reply,
+        which is always alone in flight
+    """
+    waiting = self.pending.get(key)
+    if not waiting:
+      return True
+    return fut is None and waiting[0][1] is None
+
+  def _release(self, key):
+    """ Send whatever was held back on key that can go out now """
+    held = self.held.get(key)
+    while held and self._can_send(key, held[0][4]):
+      self._send(*held.popleft())
+
+  def _send(self, sock, enc_bytes, addr, timeout, fut):
+    module = None
+    if fut is not None:
+      self._drain(sock)
+      try:
+        module = _module(dec(enc_bytes))
+      except ValueError:
+        pass
+
+    try:
+      if addr is None:
+        sock.send(enc_bytes)
+      else:
+        sock.sendto(enc_bytes, addr)
+    except OSError as e:
+      if self._claim(fut):
+        fut.set_exception(e)
+    else:
+      deadline = time.monotonic() + timeout
+      waiting = self.pending.setdefault((sock, addr), deque())
+      waiting.append((deadline, fut, module))
+
+  def _drain(self, sock):
+    """ Throw away stale replies sitting on sock. Skipped while anything on
+        sock is still in flight, since its reply may be among them
+    """
+    if any(w for (s, _), w in self.pending.items() if s is sock):
+      return
+
+    while True:
+      try:
+        sock.recv(1024)
+      except BlockingIOError:
+        return
+      except ConnectionError:
+        pass
+      except OSError:
+        return
+
+  def _read_response(self, key):
+    sock, connected = key.fileobj, key.data
+    try:
+      if connected:
+        data, addr = sock.recv(1024), None
+      else:
+        data, addr = sock.recvfrom(1024)
+    except OSError:
+      return
+
+    waiting = self.pending.get((sock, addr))
+    if not waiting:
+      return
+
+    deadline, fut, module = waiting[0]
+    if fut is None:
+      waiting.popleft()
+    else:
+      try:
+        response = dec(data)
+        if module is not None and _module(response) != module:
+          return
+      except Exception as e:
+        waiting.popleft()
+        if self._claim(fut):
+          fut.set_exception(e)
+      else:
+        waiting.popleft()
+        if self._claim(fut):
+          fut.set_result(response)
+
+    self._release((sock, addr))
+
+  def _next_timeout(self):
+    deadlines = [w[0][0] for w in self.pending.values() if w]
+    if deadlines:
+      return max(0.0, min(deadlines) - time.monotonic())
+    return None
+
+  def _expire(self):
+    now = time.monotonic()
+    for key, waiting in list(self.pending.items()):
+      if waiting and waiting[0][0] <= now:
+        while waiting and waiting[0][0] <= now:
+          deadline, fut, module = waiting.popleft()
+          if self._claim(fut):
+            fut.set_exception(socket.timeout('No response from bulb'))
+        self._release(key)
+
+
+_io = BulbIO()
 
 
 class Bulb:
 
-  SYS_CMD = '{"system":{"get_sysinfo":{}}}'
+  __slots__ = (
+    'addr', 'sock', 'dest', 'closed', 'transition_period_ms', 'name',
+    'power', 'state', '_hue', '_sat', '_temp', '_bright',
+  )
+
+  SYS_CMD = b'{"system":{"get_sysinfo":{}}}'
+
+  STATE_CMD = (
+    b'{"smartlife.iot.smartbulb.lightingservice":{"transition_light_state":'
+    b'{"on_off":1,"hue":%d,"saturation":%d,"color_temp":%d,"brightness":%d,'
+    b'"transition_period":%d}}}'
+  )
 
   @staticmethod
   def trans_cmd_str(cmd):
     """ Make a transition command string from the command """
-    return ''.join((
-      '{"smartlife.iot.smartbulb.lightingservice":{',
-      '"transition_light_state":', json.dumps(cmd), '}}'
+    return b''.join((
+      b'{"smartlife.iot.smartbulb.lightingservice":{',
+      b'"transition_light_state":', orjson.dumps(cmd), b'}}'
     ))
 
   @staticmethod
   def all(timeout=1):
     """ Find all of the lightbulbs on your network. Most respond in
-        less than 0.1 seconds
+        less than 0.1 seconds. Replies are collected for timeout seconds
+        in total, and each one is parsed while waiting on the next
     """
-    msg = enc(Bulb.SYS_CMD)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    s.sendto(msg, ('255.255.255.255', 9999))
+    s.sendto(_SYS_CMD_ENC, ('255.255.255.255', 9999))
 
+    buf = bytearray(1024)
+    view = memoryview(buf)
     lights = []
+    deadline = time.monotonic() + timeout
     try:
       while True:
-        s.settimeout(timeout)
-        data, addr = s.recvfrom(1024)
-        lights.append(Bulb(addr, sysinfo=dec(data)))
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+
+        s.settimeout(remaining)
+        n, addr = s.recvfrom_into(buf)
+        lights.append(Bulb(addr, sysinfo=dec(view[:n])))
 
     except socket.timeout:
       pass
 
+    finally:
+      s.close()
+
     return lights
 
-  def __init__(self, ip_port, sysinfo=None, sock=GlobalSocket):
+  @staticmethod
+  def batch_cmd(bulbs, enc_cmds, timeout=1):
+    """ Send an encoded command to each bulb before waiting on any of the
+        responses, so the round trips overlap instead of running one after
+        another. Returns the decoded responses in bulb order, with None for
+        any bulb that didn't answer within the timeout
+    """
+    futures = [
+      bulb.cmd_enc(enc_bytes, timeout)
+      for bulb, enc_bytes in zip(bulbs, enc_cmds)
+    ]
+
+    responses = []
+    for fut in futures:
+      try:
+        responses.append(fut.result())
+      except socket.timeout:
+        responses.append(None)
+    return responses
+
+  def __init__(self, ip_port, sysinfo=None, sock=None):
+    """ Each bulb gets its own UDP socket connected to it, so sends skip the
+        per-call destination lookup. Pass sock to share an unconnected one.
+        Call close() when done with the bulb to release its socket
+    """
     self.addr = ip_port
-    self.sock = sock
+    if sock is None:
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.sock.connect(ip_port)
+      self.dest = None
+    else:
+      self.sock = sock
+      self.dest = ip_port
+    self.closed = False
     self.transition_period_ms = 0
     self.name = 'unknown'
 
@@ -65,52 +376,87 @@ class Bulb:
       self.refresh()
 
   def _read_sysinfo(self, sysinfo):
-    js = json.loads(sysinfo)['system']['get_sysinfo']
+    js = orjson.loads(sysinfo)['system']['get_sysinfo']
 
     self.name = js['alias']
     self.power = js['light_state']['on_off'] == 1
     state = js['light_state'] if self.power else js['preferred_state'][0]
     self.state = state
+    self._hue = state['hue']
+    self._sat = state['saturation']
+    self._temp = state['color_temp']
+    self._bright = state['brightness']
 
   def write_state(self, transition_ms=0):
-    d = {}
+    """ Send the bulb's power and color state. Timed transitions are
+        animation steps, so they're sent without waiting for a reply
+    """
+    send = self.cmd_noreply if transition_ms > 0 else self.cmd_enc
     if self.power:
-      d['on_off'] = 1
-      d['hue'] = self.hue
-      d['saturation'] = self.sat
-      d['color_temp'] = self.temp
-      d['brightness'] = self.bright
-      d['transition_period'] = transition_ms
-    else:
-      d['on_off'] = 0
+      cmd_bytes = Bulb.STATE_CMD % (
+        self._hue, self._sat, self._temp, self._bright, transition_ms)
+      return send(enc(cmd_bytes))
 
-    return self.cmd(Bulb.trans_cmd_str(d))
+    return send(_encoded_trans((('on_off', 0),)))
 
   def hue(self, hue):
-    hue_cmd = Bulb.trans_cmd_str({'hue': hue})
-    return self.cmd(hue_cmd)
+    self._hue = hue
+    self.cmd_noreply(_encoded_trans((('hue', hue),)))
 
   def onoff(self):
     self.power = not self.power
     value = 1 if self.power else 0
-    return self.cmd(Bulb.trans_cmd_str({'on_off': value}))
+    self.cmd_noreply(_encoded_trans((('on_off', value),)))
 
   def off(self):
     if self.power:
       self.power = False
-      return self.cmd(Bulb.trans_cmd_str({'on_off': 0}))
+      self.cmd_noreply(_encoded_trans((('on_off', 0),)))
 
   def cmd(self, cmd_string):
-    e = enc(cmd_string)
-    self.sock.sendto(e, self.addr)
-    data, addr = self.sock.recvfrom(1024)
-    return dec(data)
+    return self.cmd_enc(enc(cmd_string))
+
+  def cmd_enc(self, enc_bytes, timeout=1):
+    """ Send an already encoded command. Returns a Future for the decoded
+        response, which is filled in by the I/O thread
+    """
+    if self.closed:
+      raise OSError(f"{self} is closed")
+    return _io.submit(self.sock, enc_bytes, self.dest, timeout)
+
+  def cmd_noreply(self, enc_bytes):
+    """ Send an already encoded command without waiting on or decoding the
+        response
+    """
+    if self.closed:
+      raise OSError(f"{self} is closed")
+    _io.submit(self.sock, enc_bytes, self.dest, reply=False)
 
   def refresh(self):
-    self._read_sysinfo(self.cmd(Bulb.SYS_CMD))
+    self._read_sysinfo(self.cmd_enc(_SYS_CMD_ENC).result())
+
+  def close(self):
+    """ Cancel any commands in flight and close the bulb's own socket. A
+        shared socket is left open
+    """
+    if self.closed:
+      return
+    self.closed = True
+    _io.close(self.sock, self.dest)
 
   def __str__(self):
     return f"Bulb \"{self.name}\" @ {self.addr[0]}"
 
   def __repr__(self):
-    return f"<{self.__str__()}>"
\ No newline at end of file
+    return f"<{self.__str__()}>"
+
+
+_SYS_CMD_ENC = enc(Bulb.SYS_CMD)
+
+
+@functools.lru_cache(maxsize=1024)
+def _encoded_trans(kv_tuple):
+  """ The encoded transition command for a tuple of (key, value) pairs. Most
+      commands are repeats (on/off, hue sweeps), so these are cached
+  """
+  return enc(Bulb.trans_cmd_str(dict(kv_tuple)))
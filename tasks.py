@@ -1,3 +1,7 @@
+import math
+import sys
+import threading
+
 import numpy as np
 from event_loop import *
 
@@ -5,17 +9,37 @@ from event_loop import *
 class SoundLevelPoller(Poller):
   """ Poll for the absolute volume on the default microphone """
   def setup(self):
-    self.stream = sd.InputStream(samplerate=12000, blocksize=1, device=2)
+    self.lock = threading.Lock()
+    self.sum_sq = 0.0
+    self.count = 0
+    self.level = 0.0
+    self.stream = sd.InputStream(
+      samplerate=12000, blocksize=0, device=2, callback=self._audio_cb)
+
+    # Levels are scaled to one frame's worth of samples, so they don't jump
+    # around with how many blocks happened to land between polls
+    self.frame_samples = (
+      self.stream.samplerate * self.stream.channels * self.el.seconds_per_frame)
     self.stream.start()
 
+  def _audio_cb(self, indata, frames, time_info, status):
+    """ Called on PortAudio's thread with each block of input. Only the sum
+        of squares is kept, so poll never has to read or copy samples
+    """
+    d = indata.reshape(-1)
+    sum_sq = float(d @ d)
+    with self.lock:
+      self.sum_sq += sum_sq
+      self.count += d.size
+
   def poll(self):
-    self.avail = self.stream.read_available
+    with self.lock:
+      sum_sq, count = self.sum_sq, self.count
+      self.sum_sq, self.count = 0.0, 0
 
-    if self.avail:
-      data, overflowed = self.stream.read(self.avail)
-      return np.linalg.norm(data)
-    else:
-      return 0.0
+    if count:
+      self.level = math.sqrt(sum_sq * self.frame_samples / count)
+    return self.level
 
   def finish(self):
     self.stream.stop()
@@ -23,15 +47,28 @@ class SoundLevelPoller(Poller):
 
 
 class SoundLevelPrinter(Task):
-  """ Prints the sound level as measured by the level poller passed in
+  """ Prints the sound level as measured by the level poller passed in, at
+      no more than max_fps lines per second
   """
 
-  def __init__(self, levelPoller):
+  BARS = [b'#' * i + b'\n' for i in range(128)]
+
+  def __init__(self, levelPoller, max_fps=30):
     self.poller = levelPoller
+    self.max_fps = max_fps
+
+  def setup(self):
+    ratio = 1 / (self.max_fps * self.el.seconds_per_frame)
+    self.stride = max(1, math.ceil(ratio - 1e-9))
+    self.out = sys.stdout.buffer
 
   def tick(self):
-    bars = round(self.poller.value * 10)
-    print('#' * bars)
+    if self.el.frame % self.stride:
+      return True
+
+    bars = min(round(self.poller.value * 10), 127)
+    self.out.write(SoundLevelPrinter.BARS[bars])
+    self.out.flush()
     return True
 
 
@@ -45,13 +82,17 @@ class SystemLoadPrinter(Task):
 
   def setup(self):
     self.data = np.full(self.avg_len, self.el.seconds_per_frame)
+    self.running_sum = float(self.data.sum())
 
   def tick(self):
     index = self.el.frame % self.avg_len
-    self.data[index] = self.el.sleep_time
+    old = self.data.item(index)
+    v = self.el.sleep_time
+    self.data[index] = v
+    self.running_sum += v - old
 
     if index == 0:
-      avg_sleep = np.average(self.data)
+      avg_sleep = self.running_sum / self.avg_len
       avg_load = (1.0 - avg_sleep / self.el.seconds_per_frame) * 100
       print(f"System Load: {round(avg_load, 2)}%")
     return True
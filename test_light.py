@@ -0,0 +1,68 @@
+import socket
+import threading
+import time
+import unittest
+
+import orjson
+
+from light import Bulb, dec, enc
+
+
+def sysinfo(alias):
+  return orjson.dumps({'system': {'get_sysinfo': {
+    'alias': alias,
+    'light_state': {
+      'on_off': 1, 'hue': 0, 'saturation': 0, 'color_temp': 0,
+      'brightness': 50,
+    },
+  }}})
+
+
+class FakeBulb:
+  """ A local UDP responder that answers each command after the next delay
+      in its script. Sysinfo requests get the alias for that request, and
+      transitions get an ack
+  """
+
+  def __init__(self, script):
+    self.script = list(script)
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.addr = self.sock.getsockname()
+    threading.Thread(target=self.serve, daemon=True).start()
+
+  def serve(self):
+    while True:
+      data, addr = self.sock.recvfrom(1024)
+      delay, alias = self.script.pop(0)
+      if 'get_sysinfo' in dec(data):
+        reply = sysinfo(alias)
+      else:
+        reply = Bulb.trans_cmd_str({'err_code': 0})
+      threading.Timer(delay, self.sock.sendto, (enc(reply), addr)).start()
+
+
+class ResponseMatchingTest(unittest.TestCase):
+
+  def test_late_reply_is_not_handed_to_a_later_command(self):
+    fake = FakeBulb([
+      (0.4, 'stale'),   # A: answers after it has timed out
+      (0.3, None),      # B: fire and forget hue, acked after A's late reply
+      (0.2, 'fresh'),   # C: refresh, answered after B's ack
+    ])
+    bulb = Bulb(fake.addr, sysinfo=sysinfo('initial'))
+    try:
+      with self.assertRaises(socket.timeout):
+        bulb.cmd_enc(enc(Bulb.SYS_CMD), timeout=0.2).result()
+
+      bulb.hue(5)
+      time.sleep(0.25)
+
+      bulb.refresh()
+      self.assertEqual(bulb.name, 'fresh')
+    finally:
+      bulb.close()
+
+
+if __name__ == '__main__':
+  unittest.main()